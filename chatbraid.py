@@ -1,20 +1,338 @@
 #!/usr/bin/env python3
 
+import os
 import logging
-import subprocess
+import re
 import json
+import asyncio
+import hashlib
+import threading
+import collections
+import functools
+import weakref
+import sqlite3
+import queue
+import zlib
+import time
+import warnings
 import requests
-import openai
 import copy
 from tbraid import tbraid
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 
 logger = logging.getLogger(__name__)
 
+# Named '%(key)s'-style fields or '%%' escapes, what formatting a prompt is for
+_FMT_RE = re.compile(r'%\([^)]*\)|%%')
+
+# Plain '%(key)s' fields, the only spec _compile_template splits on
+_FIELD_RE = re.compile(r'%\(([^)]*)\)s')
+
+
+def _has_fields(prompt):
+    """ Whether any string of a $llm prompt has a named '%(key)' field. """
+    if isinstance(prompt, str):
+        return '%(' in prompt
+    if isinstance(prompt, (list, tuple)):
+        return any(_has_fields(p) for p in prompt)
+    return False
+
+
+@functools.lru_cache(maxsize=512)
+def _compile_template(s):
+    """
+    Split a prompt template into its literal runs and field names, parsed once
+    per template so repeated prompts (every '$foreach' item shares one) only
+    pay for the key lookups.  Returns (literals, keys), literals having one
+    more entry than keys, or None when anything but plain '%(key)s' fields is
+    used and the template has to go through '%' formatting.
+    """
+    parts = _FIELD_RE.split(s)
+    literals = tuple(parts[0::2])
+    if any('%' in lit for lit in literals):
+        return None
+    return literals, tuple(parts[1::2])
+
+
+# Request keys that never change what the model answers, left out of cache keys
+_UNCACHED_KEYS = frozenset(('meta', 'no_cache', 'semantic_cache', 'stream'))
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class _SemanticCache:
+    """
+    Nearest-prompt lookup behind the exact cache, so paraphrased or lightly
+    templated prompts can reuse a stored response.
+
+    Prompts are embedded with a small local model (sentence-transformers'
+    all-MiniLM-L6-v2 unless an encoder callable is given) and kept per scope,
+    a scope being everything in the request apart from the prompt.  Each scope
+    holds its unit-length embeddings as rows of a preallocated float32 matrix,
+    so a lookup is a single BLAS matrix-vector product with no per-row norms,
+    and a full scope overwrites its oldest row in place.
+    """
+    def __init__(self, encoder=None, threshold=0.92, max_size=1024,
+                 model_name='all-MiniLM-L6-v2'):
+        if np is None:
+            raise ImportError("semantic_cache requires numpy")
+        self._encoder = encoder
+        self._model_name = model_name
+        self.threshold = threshold
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # scope -> [embeddings (capacity, dim), rows used, next row, values]
+        self._scopes = {}
+
+    def embed(self, prompt):
+        """ Return the prompt's embedding scaled to unit length. """
+        if self._encoder is None:
+            with self._lock:
+                if self._encoder is None:
+                    from sentence_transformers import SentenceTransformer
+                    self._encoder = SentenceTransformer(self._model_name).encode
+        if not isinstance(prompt, str):
+            prompt = json.dumps(prompt)
+        q = np.asarray(self._encoder(prompt), dtype=np.float32).ravel()
+        norm = float(np.linalg.norm(q))
+        return q / norm if norm else q
+
+    def get(self, scope, q):
+        with self._lock:
+            entry = self._scopes.get(scope)
+            if entry is None:
+                return None
+            embeddings, used, _, values = entry
+            # Rows and q are unit length, so the dot product is the cosine
+            scores = embeddings[:used] @ q
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                return values[best]
+            return None
+
+    def put(self, scope, q, value):
+        with self._lock:
+            entry = self._scopes.get(scope)
+            if entry is None:
+                embeddings = np.empty((min(16, self.max_size), q.shape[0]), dtype=np.float32)
+                entry = self._scopes[scope] = [embeddings, 0, 0, []]
+            embeddings, used, row, values = entry
+            if row == embeddings.shape[0] and row < self.max_size:
+                # Grow geometrically up to max_size
+                grown = np.empty((min(2 * row, self.max_size), q.shape[0]), dtype=np.float32)
+                grown[:used] = embeddings[:used]
+                embeddings = entry[0] = grown
+            row %= self.max_size
+            embeddings[row] = q
+            if row < len(values):
+                values[row] = value
+            else:
+                values.append(value)
+            entry[1] = max(used, row + 1)
+            entry[2] = row + 1
+
+# Suggested location for LLMManager(cache_path=...)
+DEFAULT_CACHE_PATH = os.path.expanduser('~/.cache/chatbraid/cache.db')
+
+
+def _jsonable(ob):
+    # Response objects (usage and such) are pydantic models in openai>=1.0.0
+    if hasattr(ob, 'model_dump'):
+        return ob.model_dump()
+    return repr(ob)
+
+
+class _DiskCache:
+    """
+    sqlite store of exact-cache entries that outlives the process, sitting
+    under the in-process LRU.  Reads use a connection per thread against the
+    WAL journal, while writes are queued to one writer thread so callers never
+    wait on the write lock.  Text and meta props are stored zlib-compressed
+    JSON, so props like 'usage' come back as plain dicts.  With a ttl, expired
+    rows are ignored on read and pruned when the store is opened.
+    """
+    def __init__(self, path, ttl=None):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self._closed = False
+        self._local = threading.local()
+        self._queue = queue.Queue()
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('CREATE TABLE IF NOT EXISTS r'
+                     '(k BLOB PRIMARY KEY, v BLOB, meta BLOB, ts INTEGER)')
+        if ttl is not None:
+            conn.execute('DELETE FROM r WHERE ts < ?', (int(time.time() - ttl),))
+        conn.commit()
+        conn.close()
+        # The writer only holds the path and queue, not self, so an unused
+        # cache can be collected; the finalizer stops the writer then, or at
+        # exit, after committing what's queued.
+        self._writer = threading.Thread(
+            target=self._write_loop, args=(path, self._queue),
+            name='chatbraid.cache', daemon=True)
+        self._writer.start()
+        self._finalizer = weakref.finalize(
+            self, self._stop_writer, self._queue, self._writer)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def get(self, key):
+        if self._closed:
+            return None
+        row = self._conn().execute(
+            'SELECT v, meta, ts FROM r WHERE k = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        v, meta, ts = row
+        if self.ttl is not None and ts + self.ttl < time.time():
+            return None
+        return (json.loads(zlib.decompress(v)),
+                json.loads(zlib.decompress(meta)))
+
+    def put(self, key, text, props):
+        if self._closed:
+            return
+        v = zlib.compress(json.dumps(text).encode())
+        meta = zlib.compress(json.dumps(props, default=_jsonable).encode())
+        self._queue.put((key, v, meta, int(time.time())))
+
+    @staticmethod
+    def _write_loop(path, q):
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute('PRAGMA synchronous=NORMAL')
+        while True:
+            rows = [q.get()]
+            # Commit whatever else piled up in the same transaction
+            while True:
+                try:
+                    rows.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            done = None in rows
+            rows = [r for r in rows if r is not None]
+            if rows:
+                with conn:
+                    conn.executemany(
+                        'INSERT OR REPLACE INTO r VALUES (?, ?, ?, ?)', rows)
+            for _ in range(len(rows) + done):
+                q.task_done()
+            if done:
+                break
+        conn.close()
+
+    @staticmethod
+    def _stop_writer(q, writer):
+        if writer.is_alive():
+            q.put(None)
+            writer.join()
+
+    def flush(self):
+        """ Block until every queued write is committed. """
+        if not self._closed:
+            self._queue.join()
+
+    def close(self):
+        """ Commit queued writes and stop the writer; later puts are dropped. """
+        self._closed = True
+        self._finalizer()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class _OpenAIStream:
+    """
+    Accumulates a streamed chat completion, handing each text delta to an
+    optional callback as it arrives.
+    """
+    def __init__(self, callback=None):
+        self.callback = callback if callable(callback) else None
+        self.parts = []
+        self.usage = None
+        self.id = None
+
+    def add(self, chunk):
+        self.id = self.id or getattr(chunk, 'id', None)
+        if getattr(chunk, 'usage', None) is not None:
+            self.usage = chunk.usage
+        if chunk.choices:
+            delta = chunk.choices[0].delta.content
+            if delta:
+                self.parts.append(delta)
+                if self.callback:
+                    self.callback(delta)
+
+    def text(self):
+        return ''.join(self.parts)
+
+
 class LLMManager:
-    def __init__(self, openai_api_key=None, ollama_path='ollama'):
+    def __init__(self, openai_api_key=None, ollama_path=None, ollama_url=None,
+                 ollama_timeout=300, cache_size=1024, cache_path=None,
+                 cache_ttl=None, semantic_cache=None, semantic_threshold=0.92):
+        """
+        ollama_path: deprecated and ignored, Ollama is reached over HTTP now.
+        ollama_url: base url of the Ollama server, defaults to $OLLAMA_HOST or
+                    http://localhost:11434.  Set OLLAMA_NUM_PARALLEL on the
+                    server so concurrent braid threads are actually served in
+                    parallel rather than queued.
+        cache_size: number of responses memoized in-process by exact request,
+                    0 disables.  Single requests opt out with 'no_cache': True.
+        cache_path: sqlite file persisting exact-cache entries across runs
+                    (DEFAULT_CACHE_PATH is a fine choice), entries older than
+                    cache_ttl seconds being ignored if that's set.
+        Requests with 'stream' set are streamed from OpenAI; if it's a callable
+        it gets each text delta as it arrives (or the whole cached text once).
+        semantic_cache: True, or an encoder callable (text -> vector), to also
+                    reuse responses of prompts whose embeddings score at least
+                    semantic_threshold in cosine similarity.  Needs numpy, and
+                    sentence-transformers unless an encoder is given.  Off by
+                    default, since near-identical prompts can still ask
+                    different things.  Single requests opt out with
+                    'semantic_cache': False (chatbraid does so for templated
+                    prompts).
+        """
         self.openai_api_key = openai_api_key
-        self.ollama_path = ollama_path
+        if ollama_path is not None:
+            warnings.warn(
+                "LLMManager(ollama_path=...) is ignored, use ollama_url",
+                DeprecationWarning, stacklevel=2)
+        ollama_url = ollama_url or os.getenv('OLLAMA_HOST') or 'http://localhost:11434'
+        if '://' not in ollama_url:
+            ollama_url = f'http://{ollama_url}'
+        self.ollama_url = ollama_url.rstrip('/')
+        self.ollama_timeout = ollama_timeout
+        # Reused across calls for keep-alive connections to the Ollama server
+        self._session = requests.Session()
+        # OpenAI clients (and their connection pools) are made once on first
+        # use; async ones are tied to the event loop they're made on.
+        self._openai_client = None
+        self._openai_aclients = weakref.WeakKeyDictionary()
+        self._client_lock = threading.Lock()
+        # LRU of cache key -> (response text, meta props)
+        self._cache = collections.OrderedDict()
+        self._cache_max = cache_size
+        self._cache_lock = threading.Lock()
+        self._disk = _DiskCache(cache_path, ttl=cache_ttl) if cache_path else None
+        self._semantic = None
+        if semantic_cache:
+            self._semantic = _SemanticCache(
+                encoder=None if semantic_cache is True else semantic_cache,
+                threshold=semantic_threshold,
+                max_size=cache_size or 1024)
 
     def call(self, request, meta=None):
         """
@@ -27,7 +345,36 @@ class LLMManager:
             ... other provider-specific params ...
         }
         meta: optional dict to be filled with extra info from the LLM response.
+        Identical requests are answered from the cache unless 'no_cache' is set.
+        """
+        key, near = self._cache_keys(request)
+        hit = self._cache_get(key, near)
+        if hit is not None:
+            return self._cache_hit(hit, meta, request)
+        props = {}
+        text = self._dispatch(request, meta=props)
+        return self._cache_put(key, near, text, props, meta)
+
+    async def acall(self, request, meta=None):
+        """
+        Coroutine counterpart of call(), same request format and meta handling,
+        for callers running their own event loop (e.g. asyncio.gather over many
+        prompts).  chatbraid's $llm steps await it under arun(), and use call()
+        under run().
         """
+        key, near = self._cache_keys(request)
+        # Lookups may embed the prompt (loading the model the first time) or
+        # read sqlite, so keep them off the event loop.
+        hit = None
+        if key is not None or near is not None:
+            hit = await asyncio.to_thread(self._cache_get, key, near)
+        if hit is not None:
+            return self._cache_hit(hit, meta, request)
+        props = {}
+        text = await self._adispatch(request, meta=props)
+        return await asyncio.to_thread(self._cache_put, key, near, text, props, meta)
+
+    def _dispatch(self, request, meta=None):
         provider = request.get('provider', 'openai')
         if provider == 'openai':
             return self._call_openai(request, meta=meta)
@@ -36,17 +383,121 @@ class LLMManager:
         else:
             raise ValueError(f"Unsupported LLM provider: {provider}")
 
+    async def _adispatch(self, request, meta=None):
+        provider = request.get('provider', 'openai')
+        if provider == 'openai':
+            return await self._acall_openai(request, meta=meta)
+        elif provider == 'ollama':
+            return await self._acall_ollama(request, meta=meta)
+        else:
+            raise ValueError(f"Unsupported LLM provider: {provider}")
+
+    @staticmethod
+    def _digest(ob):
+        blob = json.dumps(ob, sort_keys=True, default=repr).encode()
+        return hashlib.blake2b(blob, digest_size=16).digest()
+
+    def _cache_keys(self, request):
+        """
+        Return (exact key, semantic lookup) for a request, either being None
+        when that cache layer doesn't apply.  The semantic lookup is a
+        [scope, prompt] pair, scope covering everything but the prompt; the
+        prompt is swapped for its embedding once the exact cache has missed.
+        """
+        if request.get('no_cache'):
+            return None, None
+        canon = {k: request[k] for k in request
+                 if not (k.startswith('$') or k in _UNCACHED_KEYS)}
+        key = None
+        if self._cache_max or self._disk is not None:
+            key = self._digest(dict(canon, **{'$llm': request.get('$llm')}))
+        near = None
+        if self._semantic is not None and request.get('semantic_cache', True):
+            near = [self._digest(canon), request.get('$llm')]
+        return key, near
+
+    def _lru_put(self, key, value):
+        if self._cache_max:
+            with self._cache_lock:
+                self._cache[key] = value
+                self._cache.move_to_end(key)
+                while len(self._cache) > self._cache_max:
+                    self._cache.popitem(last=False)
+
+    def _cache_get(self, key, near=None):
+        if key is not None:
+            with self._cache_lock:
+                hit = self._cache.get(key)
+                if hit is not None:
+                    self._cache.move_to_end(key)
+                    return hit
+            if self._disk is not None:
+                hit = self._disk.get(key)
+                if hit is not None:
+                    text, props = hit
+                    self._lru_put(key, hit)
+                    return text, dict(props, cached='disk')
+        if near is not None:
+            near[1] = self._semantic.embed(near[1])
+            hit = self._semantic.get(*near)
+            if hit is not None:
+                text, props = hit
+                return text, dict(props, cached='semantic')
+        return None
+
+    def _cache_hit(self, hit, meta, request):
+        text, props = hit
+        self._fill_meta(meta, dict(props, cached=props.get('cached') or True))
+        if callable(request.get('stream')):
+            request['stream'](text)
+        return text
+
+    def _cache_put(self, key, near, text, props, meta):
+        props['cached'] = False
+        if key is not None:
+            self._lru_put(key, (text, props))
+            if self._disk is not None:
+                self._disk.put(key, text, props)
+        if near is not None:
+            self._semantic.put(*near, (text, props))
+        self._fill_meta(meta, props)
+        return text
+
+    @staticmethod
+    def _fill_meta(meta, all_props):
+        # Fill only the keys the caller asked for, or everything if none were.
+        if meta is not None:
+            keys_to_assign = set(meta.keys()) & set(all_props.keys())
+            if not keys_to_assign:
+                keys_to_assign = set(all_props.keys())
+            for k in keys_to_assign:
+                meta[k] = all_props[k]
+
+    def _openai(self):
+        with self._client_lock:
+            if self._openai_client is None:
+                self._openai_client = OpenAI(api_key=self.openai_api_key)
+            return self._openai_client
+
+    def _aopenai(self):
+        loop = asyncio.get_running_loop()
+        with self._client_lock:
+            client = self._openai_aclients.get(loop)
+            if client is None:
+                client = AsyncOpenAI(api_key=self.openai_api_key)
+                self._openai_aclients[loop] = client
+            return client
+
     def _call_openai(self, request, meta=None):
         if not self.openai_api_key:
             raise ValueError("OpenAI API key not set")
-        openai.api_key = self.openai_api_key
 
         model = request.get('model', 'gpt-4.1-mini')
         prompt = request.get('$llm')
         if prompt is None:
             raise ValueError("Prompt ('$llm') not provided")
 
-        logger.debug(f"OpenAI call: model={model}, prompt={prompt}")
+        logger.debug("OpenAI call: model=%s, prompt=%s", model, prompt)
 
         # For chat models, wrap prompt in messages list
         messages = [
@@ -54,25 +505,79 @@ class LLMManager:
         ]
 
         # Use new OpenAI API client style per openai>=1.0.0
-        client = OpenAI(api_key=self.openai_api_key)
-        response = client.chat.completions.create(
-            model=model,
-            messages=messages
-        )
+        client = self._openai()
+        if request.get('stream'):
+            response = client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                stream_options={'include_usage': True}
+            )
+            acc = _OpenAIStream(request['stream'])
+            for chunk in response:
+                acc.add(chunk)
+            text, usage, rid = acc.text(), acc.usage, acc.id
+        else:
+            response = client.chat.completions.create(
+                model=model,
+                messages=messages
+            )
+            text = response.choices[0].message.content
+            usage = getattr(response, 'usage', None)
+            rid = getattr(response, 'id', None)
         # Reasonable keys to offer
         all_props = {
             'model': model,
-            'usage': getattr(response, 'usage', None),
-            'id': getattr(response, 'id', None),
+            'usage': usage,
+            'id': rid,
             'prompt': copy.deepcopy(messages),
         }
-        if meta is not None:
-            keys_to_assign = set(meta.keys()) & set(all_props.keys())
-            if not keys_to_assign:
-                keys_to_assign = set(all_props.keys())
-            for k in keys_to_assign:
-                meta[k] = all_props[k]
-        return response.choices[0].message.content
+        self._fill_meta(meta, all_props)
+        return text
+
+    async def _acall_openai(self, request, meta=None):
+        if not self.openai_api_key:
+            raise ValueError("OpenAI API key not set")
+
+        model = request.get('model', 'gpt-4.1-mini')
+        prompt = request.get('$llm')
+        if prompt is None:
+            raise ValueError("Prompt ('$llm') not provided")
+
+        logger.debug("OpenAI async call: model=%s, prompt=%s", model, prompt)
+
+        messages = [
+            {"role": "user", "content": prompt}
+        ]
+
+        client = self._aopenai()
+        if request.get('stream'):
+            response = await client.chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                stream_options={'include_usage': True}
+            )
+            acc = _OpenAIStream(request['stream'])
+            async for chunk in response:
+                acc.add(chunk)
+            text, usage, rid = acc.text(), acc.usage, acc.id
+        else:
+            response = await client.chat.completions.create(
+                model=model,
+                messages=messages
+            )
+            text = response.choices[0].message.content
+            usage = getattr(response, 'usage', None)
+            rid = getattr(response, 'id', None)
+        all_props = {
+            'model': model,
+            'usage': usage,
+            'id': rid,
+            'prompt': copy.deepcopy(messages),
+        }
+        self._fill_meta(meta, all_props)
+        return text
 
     def _call_ollama(self, request, meta=None):
         model = request.get('model')
@@ -82,44 +587,44 @@ class LLMManager:
         if prompt is None:
             raise ValueError("Ollama prompt ('$llm') not provided")
 
-        logger.debug(f"Ollama call: model={model}, prompt={prompt}")
+        logger.debug("Ollama call: model=%s, prompt=%s", model, prompt)
 
         try:
-            proc = subprocess.run(
-                [self.ollama_path, 'chat', model, '--json'],
-                input=json.dumps({"prompt": prompt}),
-                text=True,
-                capture_output=True,
-                check=True
+            resp = self._session.post(
+                f"{self.ollama_url}/api/generate",
+                json={"model": model, "prompt": prompt, "stream": False},
+                timeout=self.ollama_timeout
             )
-            output = proc.stdout.strip()
-            data = json.loads(output)
+            resp.raise_for_status()
+            data = resp.json()
             # Reasonable keys to offer
             all_props = {
                 'model': model,
                 'raw_response': data,
             }
-            if meta is not None:
-                keys_to_assign = set(meta.keys()) & set(all_props.keys())
-                if not keys_to_assign:
-                    keys_to_assign = set(all_props.keys())
-                for k in keys_to_assign:
-                    meta[k] = all_props[k]
+            self._fill_meta(meta, all_props)
             return data.get('response', '')
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Ollama call failed: {e.stderr}")
+        except requests.RequestException as e:
+            logger.error("Ollama call failed: %s", e)
             raise
 
+    async def _acall_ollama(self, request, meta=None):
+        # The ollama path is blocking, so hand it to a worker thread rather than
+        # stalling the shared event loop.
+        return await asyncio.to_thread(self._call_ollama, request, meta)
+
 class chatbraid(tbraid):
     def __init__(self, llm_manager=None, *args, default_llm_params=None, model=None, temperature=None, max_tokens=None, **kwargs):
         """
         llm_manager: instance of LLMManager or compatible interface.
                      If None, a default LLMManager is created using environment variables.
+                     Its call(request, meta=None) (and acall(), if any) receives
+                     the request as a collections.abc.Mapping, not necessarily
+                     a dict; writes to it stay out of the braid's own object.
         default_llm_params: dict of default key/values to use for all LLM calls if not provided.
         model, temperature, max_tokens, ... : common LLM parameters to set defaults easily.
         """
         if llm_manager is None:
-            import os
             openai_key = os.getenv('OPENAI_API_KEY')
             llm_manager = LLMManager(openai_api_key=openai_key)
         super().__init__(*args, **kwargs)
@@ -133,39 +638,66 @@ class chatbraid(tbraid):
             if v is not None:
                 self.default_llm_params[k] = v
 
-        # Register the LLM handler with higher priority
+        # Register the LLM handler with higher priority.  Managers with an
+        # acall() coroutine also get an async twin, so arun() awaits LLM
+        # calls on its loop instead of parking a thread on each one.
         self.register(
-            lambda a: isinstance(a, dict) and '$llm' in a,
-            self._handle_llm_call
+            None,
+            self._handle_llm_call,
+            types=dict,
+            key='$llm',
+            afunc=self._ahandle_llm_call if hasattr(llm_manager, 'acall') else None
         )
 
-    def _handle_llm_call(self, _, a, ts, key=None, *r):
-        logger.info(f'Sending LLM request: {a}')
-        try:
-            # Process the prompt(s) with current tstack (ts)
-            processed_prompt = self._process(a.get('$llm'), ts)
-
-            # Create a shallow copy of the request dict to avoid mutating original
-            request_copy = dict(a)
-            request_copy['$llm'] = processed_prompt
+    def _llm_request(self, a, ts, key):
+        """ Build the (request, meta) pair a $llm step hands its manager. """
+        # Process the prompt(s) with current tstack (ts).  Each named field
+        # is looked up directly; flattening would copy the whole braid
+        # table on every call.
+        processed_prompt = self._process(a.get('$llm'), ts)
 
-            # Apply default llm params if not present in request_copy
-            for k, v in self.default_llm_params.items():
-                if k not in request_copy:
-                    request_copy[k] = v
+        # Layer the processed prompt and any missing default llm params over
+        # the original request, rather than copying the whole dict
+        overrides = {'$llm': processed_prompt}
+        for k, v in self.default_llm_params.items():
+            if k not in a:
+                overrides[k] = v
+        # Prompts filled from one template (every $foreach item, say) differ
+        # only by the interpolated values and embed as near-duplicates, so a
+        # semantic hit would hand one item another's answer.  Keep them to
+        # exact matches unless the request says otherwise.
+        if 'semantic_cache' not in a and _has_fields(a.get('$llm')):
+            overrides['semantic_cache'] = False
+        request_copy = collections.ChainMap(overrides, a)
 
-            # Determine meta dict: from $llm['meta'], or create and store in _ttable[key]['meta']
-            meta = None
-            if 'meta' in a:
-                meta = a['meta'] if isinstance(a['meta'], dict) else {}
-                if key is not None and hasattr(self, "_ttable") and key in self._ttable:
-                    self._ttable[key]['meta'] = meta
+        # Determine meta dict: from $llm['meta'], or create and store in _ttable[key]['meta']
+        meta = None
+        if 'meta' in a:
+            meta = a['meta'] if isinstance(a['meta'], dict) else {}
+            if key is not None and hasattr(self, "_ttable") and key in self._ttable:
+                self._ttable[key]['meta'] = meta
+        return request_copy, meta
 
+    def _handle_llm_call(self, _, a, ts, key=None, *r):
+        logger.info('Sending LLM request: %s', a)
+        try:
+            request_copy, meta = self._llm_request(a, ts, key)
             response = self.llm_manager.call(request_copy, meta=meta)
-            logger.info(f'LLM response received')
+            logger.info('LLM response received')
+            return response
+        except Exception as e:
+            logger.error('LLM call failed: %s', e, exc_info=True)
+            raise
+
+    async def _ahandle_llm_call(self, _, a, ts, key=None, *r):
+        logger.info('Sending async LLM request: %s', a)
+        try:
+            request_copy, meta = self._llm_request(a, ts, key)
+            response = await self.llm_manager.acall(request_copy, meta=meta)
+            logger.info('LLM response received')
             return response
         except Exception as e:
-            logger.error(f'LLM call failed: {e}', exc_info=True)
+            logger.error('LLM call failed: %s', e, exc_info=True)
             raise
 
     def _process(self, prompt, tstack):
@@ -177,16 +709,26 @@ class chatbraid(tbraid):
           - tuple/list of two strings (system, user)
           - list of pairs [ [role, content], ... ] for full conversation
 
-        tstack: tablestack instance used as dict for string formatting
+        tstack: tablestack instance (or any mapping) used for string formatting
 
-        Returns the processed prompt in the same structure.
+        Returns the processed prompt in the same structure.  Strings with
+        neither a named '%(key)' field nor a '%%' escape are passed through
+        untouched.
         """
         def format_str(s):
-            if isinstance(s, str) and '%' in s:
+            if isinstance(s, str) and _FMT_RE.search(s):
                 try:
-                    return s % tstack
+                    compiled = _compile_template(s)
+                    if compiled is None:
+                        return s % tstack
+                    literals, keys = compiled
+                    out = [literals[0]]
+                    for k, lit in zip(keys, literals[1:]):
+                        out.append(str(tstack[k]))
+                        out.append(lit)
+                    return ''.join(out)
                 except KeyError as e:
-                    logger.warning(f"Missing key {e} in tstack for prompt formatting")
+                    logger.warning("Missing key %s in tstack for prompt formatting", e)
                     return s
             return s
 
@@ -4,10 +4,14 @@ import re
 import sys
 import json
 import time
+import asyncio
+import inspect
 import fnmatch
 import logging
+import itertools
 import threading
 import traceback
+import concurrent.futures
 
 
 logging.basicConfig(
@@ -17,6 +21,24 @@ logging.basicConfig(
 	format='%(levelname)s (<%(threadName)s>): %(message)s')
 logger = logging.getLogger(__name__)
 
+__all__ = [
+	'tbraid','tablestack','matchable',
+	'UnfinishedThreadError','KeyOverrideAttemptError',
+	'NoMatchedFunctionError','WaitTimeoutError']
+
+# Wait alias literal, '@key1,key2,...', minus any trailing whitespace.
+_ALIAS_RE = re.compile(r'@(.*?)\s*\Z',re.S)
+
+# Source of tablestack/tbraid mutation stamps, unique and increasing.
+_GENERATION = itertools.count(1)
+
+# Plain values that are their own result unless a handler claims the type.
+_SCALARS = frozenset((int,float,bool,str,type(None)))
+
+# Shared by every entry settled in run() itself, so never cleared.
+_COMPLETED_EVENT = threading.Event()
+_COMPLETED_EVENT.set()
+
 def _dhas(d,k):
 	try:
 		assert hasattr(d,'keys')
@@ -31,22 +53,68 @@ class WaitTimeoutError(Exception): pass
 
 class matchable:
 	def match(self,s):
-		return fnmatch.filter(self.keys(),s)
+		# Through __iter__, so a tbraid's keys are snapshotted while running.
+		return fnmatch.filter(self,s)
 	def matchitems(self,s):
 		for k in self.match(s):
 			yield (k,self[k])
 
+class _VersionedDict(dict):
+	''' dict frame that stamps itself on every write, so a tablestack can
+	tell whether its cached flat() still holds without trusting a global. '''
+	_version = 0
+	
+	def _touch(self):
+		self._version = next(_GENERATION)
+	
+	def __setitem__(self,k,v):
+		dict.__setitem__(self,k,v)
+		self._touch()
+	
+	def __delitem__(self,k):
+		dict.__delitem__(self,k)
+		self._touch()
+	
+	def update(self,*r,**kw):
+		dict.update(self,*r,**kw)
+		self._touch()
+	
+	def setdefault(self,k,v=None):
+		r = dict.setdefault(self,k,v)
+		self._touch()
+		return r
+	
+	def pop(self,*r):
+		v = dict.pop(self,*r)
+		self._touch()
+		return v
+	
+	def popitem(self):
+		v = dict.popitem(self)
+		self._touch()
+		return v
+	
+	def clear(self):
+		dict.clear(self)
+		self._touch()
+
 class tablestack(matchable):
 	''' Stack of dict-likes, primarily for getter operations, that are all
 	treated like a single dict object, moving down to find keys from the
 	top of the stack to the bottom. '''
 
+	# Stamp of the latest write through any tablestack into a frame that has
+	# no _version of its own (a plain dict, say).  Clones share frames, so such
+	# a write could change what any stack sees.
+	_generation = 0
+
 	def __init__(self,*r,**kw):
 		self._stack = []
+		self._flat = (None,None) # <- (signature, flat dict) of last flat()
 		for d in r:
 			self.add(d)
 		for k,v in kw.items():
-			self._stack[-1][k] = v
+			self[k] = v
 	
 	def add(self,d):
 		''' Add a dict-like to the stack of dict-likes for index-getting. '''
@@ -55,111 +123,185 @@ class tablestack(matchable):
 	
 	def clone(self):
 		''' Create a copy directly referencing its own stack items. '''
-		return tablestack(*self._stack)
+		# Copy the frame list as is, rather than add()ing frames one by one.
+		t = tablestack.__new__(tablestack)
+		t._stack = self._stack[:]
+		t._flat = (None,None)
+		return t
+	
+	def _signature(self):
+		# Versioned frames (_VersionedDict, tbraid) carry their own stamp, so a
+		# write only invalidates the stacks holding the frame it touched.
+		return (tablestack._generation,
+			tuple((id(b),getattr(b,'_version',None)) for b in self._stack))
 	
 	def flat(self):
-		''' Return a flat dict reflecting all visible key-val pairs in stack. '''
+		''' Return a flat dict reflecting all visible key-val pairs in stack.
+		The dict is reused until the stack changes, so treat it as read-only.
+		Frames are expected to be written through a tablestack, or to carry
+		their own _version stamp (see _VersionedDict). '''
+		sig = self._signature()
+		cached = self._flat
+		if cached[0] == sig:
+			return cached[1]
 		a = {}
+		# Checked once, the per-key message would render each whole frame.
+		debug = logger.isEnabledFor(logging.DEBUG)
 		for b in self._stack:
-			for k in iter(b):
-				logger.debug(f'b ({b}) of self._stack, k ({k})')
+			for k in list(b):
+				if debug:
+					logger.debug('b (%s) of self._stack, k (%s)',b,k)
 				try:
 					a[k] = b[k]
 				except UnfinishedThreadError:
 					a[k] = None
+		self._flat = (sig,a)
 		return a
 	
 	def top(self,off=0):
 		return self._stack[-1-off]
 
 	def __contains__(self,k):
-		try:
-			return not not self[k]
-		except KeyError:
-			return False
+		# Presence only; fetching the value could block on or trip over an
+		# unfinished thread, and falsy values are still there.
+		for t in self._stack:
+			if k in t:
+				return True
+		return False
 	
 	def __getitem__(self,k):
-		for i in range(len(self._stack)-1,0-1,-1):
-			t = self._stack[i]
+		for t in reversed(self._stack):
 			if k in t:
 				return t[k]
 		raise KeyError(k)
 	
 	def __setitem__(self,k,v):
-		self._stack[-1][k] = v
+		t = self._stack[-1]
+		t[k] = v
+		if not hasattr(t,'_version'):
+			tablestack._generation = next(_GENERATION)
 	
+	# Views of the cached flat dict; they don't follow later writes.
 	def __iter__(self):
-		for k,v in self.flat().items():
-			yield k
+		return iter(self.flat())
 	
 	def keys(self):
-		for k in self.flat().keys():
-			yield k
+		return self.flat().keys()
 	
 	def items(self):
-		for k,v in self.flat().items():
-			yield (k,v)
+		return self.flat().items()
 
 class tbraid(matchable):
 	def __init__(self,interval=.1,timeout=300,throttle=30):
+		# NOTE: wait() is Event-driven now, interval is only kept for callers.
 		self._sleep = interval
 		self._timeout = timeout
 		self._throttle = throttle
 		self._tstack = None
 		self._ttable = None
-		self._matches = []
-		self._matches_pre = []
-		self._akeyid = 0
+		# Registrations are tuples, replaced rather than appended to, so
+		# workers resolving handlers always read a whole snapshot.
+		self._matches = ()
+		self._matches_pre = ()
+		self._dispatch = {} # <- type -> candidate (check,func,key) list, lazily built
+		self._dispatch_keys = frozenset() # <- every registered key
+		self._resolved = {} # <- (type,present keys) -> func, for check-free matches
+		self._afuncs = {} # <- func -> coroutine twin arun() awaits instead
+		self._akeyids = itertools.count(1) # <- next() is atomic, no lock needed
 		self.reset()
 
 		# Register checks and actions against target objects.
 
 		# Register returning the leftovers as-is.
 		self.register(
-			lambda a:True,
+			None,
 			self._handle_base_ignore)
 		# Register literal conversions.
 		self.register(
-			lambda a:True,
+			None,
 			self._handle_base_special_literals)
 		# Register parallel thread object.
 		self.register(
-			lambda a:type(a) is dict,
-			self._handle_base_object)
+			None,
+			self._handle_base_object,
+			types=dict)
 		# Register sequential chain object (list).
 		self.register(
-			lambda a:type(a) is list,
-			self._handle_base_list)
+			None,
+			self._handle_base_list,
+			types=list)
 		# Register wait object.
 		self.register(
-			lambda a:type(a) is dict and '$wait' in a,
-			self._handle_base_wait)
+			None,
+			self._handle_base_wait,
+			types=dict,
+			key='$wait')
 		# Register arbitrary function run.
 		self.register(
-			lambda a:type(a) is dict and '$run' in a,
-			self._handle_base_run)
+			None,
+			self._handle_base_run,
+			types=dict,
+			key='$run')
 
 		# Now for items that must run before all else on account of meta behavior
 		# against the target object's keys and values.
 
 		# Register foreach object.
 		self.register(
-			lambda a:type(a) is dict and '$foreach' in a,
+			None,
 			self._handle_base_foreach,
-			pre=True)
+			pre=True,
+			types=dict,
+			key='$foreach')
+	
+	@staticmethod
+	def compile(func,**kw):
+		''' Compile a numeric helper with numba's njit (cache=True unless kw
+		says otherwise), for CPU-bound work called from a $run callable, like
+		{'$run':lambda a,t: kernel(t['xs'])}.  njit can't take the dicts and
+		tablestacks handlers get, so compile the kernel, not the callable.
+		Without numba, func comes back as it is. '''
+		# Imported here, numba loads LLVM and most braids never compile.
+		try:
+			from numba import njit
+		except ImportError:
+			return func
+		kw.setdefault('cache',True)
+		return njit(**kw)(func)
 	
 	def reset(self):
 		''' Clear out initialized properties, though no killing threads. '''
 		self._tstack = tablestack(self)
 		self._ttable = {}
+		self._events = [] # <- every entry's event, in order added
+		self._settled = 0 # <- count of _events known to be set
+		self._touch()
 		return self
 	
-	def register(self,check,func,pre=False):
-		''' Add another check and response for specific object types. '''
+	def _touch(self):
+		# Stamp a table change, so tablestacks holding this braid as a frame
+		# know their flat() view is stale.
+		self._version = next(_GENERATION)
+	
+	def register(self,check,func,pre=False,types=None,key=None,afunc=None):
+		''' Add another check and response for specific object types.  With
+		types (a type or tuple of them, matched exactly), check is only tried
+		against objects of those types and may be None to accept them all.
+		With key, only dicts holding that key (say '$wait') are considered.
+		afunc is an optional coroutine version of func for arun() to await,
+		while run() keeps calling func. '''
+		if afunc is not None:
+			self._afuncs[func] = afunc
+		if types is not None and not isinstance(types,tuple):
+			types = (types,)
 		if pre:
-			self._matches_pre.append((check,func))
+			self._matches_pre = self._matches_pre + ((check,func,types,key),)
 		else:
-			self._matches.append((check,func))
+			self._matches = self._matches + ((check,func,types,key),)
+		if key is not None:
+			self._dispatch_keys = self._dispatch_keys | {key}
+		self._dispatch = {}
+		self._resolved = {}
 		return self
 	
 	def __contains__(self,k):
@@ -172,32 +314,35 @@ class tbraid(matchable):
 		return ob['value']
 	
 	def __iter__(self):
-		for k,v in self._ttable.items():
-			yield k
+		# Snapshot the keys, since worker threads may add to the table while a
+		# tablestack is flattening it.
+		return iter(list(self._ttable))
 	
 	def keys(self):
-		for k in self._ttable.keys():
-			yield k
+		return self._ttable.keys()
 	
 	def items(self):
-		for k,v in self._ttable.items():
-			yield (k,v)
+		return self._ttable.items()
 	
-	def _autokey(self,*r):
-		self._akeyid += 1
-		return f'{"".join(r)}_{self._akeyid}'
+	def _autokey(self,prefix=''):
+		# '+=' on an int could hand two threads the same id.
+		return f'{prefix}_{next(self._akeyids)}'
 	
 	def _handle_base_ignore(self,_,a,ts,*r):
-		logger.info(f'_handle_base_ignore {a}')
+		logger.info('_handle_base_ignore %s',a)
 		return a
 	
 	def _handle_base_special_literals(self,_,a,ts,*r):
-		logger.info(f'_handle_base_special_literals {a}')
+		logger.info('_handle_base_special_literals %s',a)
 		# Alias for {$wait:...}, '@key1,key2,...'
-		if type(a) is str and len(a) and a[0] == '@':
-			toks = a.strip()[1:].split(',')
-			#return self._handle_base_wait(_,{'$wait':r},ts)
-			return {'$replace':{'$wait':toks}}
+		# Single-character test first, most strings aren't aliases.
+		if type(a) is str and a[:1] == '@':
+			toks = [t for t in _ALIAS_RE.match(a).group(1).split(',') if t]
+			# A bare '@' (or '@,') names nothing; an empty $wait would wait on
+			# every key, this one included, so leave it as a plain literal.
+			if toks:
+				#return self._handle_base_wait(_,{'$wait':r},ts)
+				return {'$replace':{'$wait':toks}}
 		if hasattr(a,'__call__'):
 			#return self._handle_base_run(_,{'$run':a},ts)
 			return {'$replace':{'$run':a}}
@@ -206,27 +351,29 @@ class tbraid(matchable):
 		return self._handle_base_ignore(_,a,ts,*r)
 	
 	def _handle_base_object(self,_,a,ts,*r):
-		logger.info(f'_handle_base_object {a} {ts}')
-		b = dict(a) # <- allow for mutability without affecting source
-		t2 = ts.clone().add({}) # <- same as ^
+		logger.info('_handle_base_object %s %s',a,ts)
+		# No copy of a needed, run() only reads the object it's handed.
+		t2 = ts.clone().add(_VersionedDict()) # <- allow for mutability without affecting source
 		# This thread defaults to waiting until all created sub-threads are done
 		# running before returning, but this can be bypassed with an '$async' flag.
-		asy = '$async' in b and (not not b['$async'])
-		kr = [k for k in b.keys() if k[0] != '$']
+		asy = '$async' in a and (not not a['$async'])
+		kr = [k for k in a if not k.startswith('$')]
 		try:
-			self.run(ob=b,ts=t2)
+			self.run(ob=a,ts=t2)
 		finally:
-			if not asy:
+			# No sub-threads means nothing to wait on; an empty wait() would
+			# otherwise wait on every key, this one included.
+			if not asy and kr:
 				self.wait(*kr)
 		if '$result' in t2:
 			return t2['$result']
 		return None
 	
 	def _handle_base_list(self,_,a,ts,*r):
-		logger.info(f'_handle_base_list {a} {ts}')
-		t2 = ts.clone().add({'$result':None})
+		logger.info('_handle_base_list %s %s',a,ts)
+		t2 = ts.clone().add(_VersionedDict({'$result':None}))
 		for ob,x in zip(a,range(len(a))):
-			logger.info(f'  base_list[{x}]: {ob}')
+			logger.info('  base_list[%s]: %s',x,ob)
 			if False:
 				f = self._find_matchfunc(ob)
 				t2['$result'] = f(self,ob,t2,*r)
@@ -234,7 +381,7 @@ class tbraid(matchable):
 		return t2['$result']
 	
 	def _handle_base_foreach(self,_,a,ts,*r):
-		logger.info(f'_handle_base_foreach {a} {ts}')
+		logger.info('_handle_base_foreach %s %s',a,ts)
 		# UNCERTAIN: Not sure if 'foreach' is the right keyword here.  Maybe
 		#   something like 'mapparam'?  And what if I want foreach mapping to
 		#   a sequential list intead of a parallel dict?
@@ -243,155 +390,316 @@ class tbraid(matchable):
 		# copying the incoming object to be returned as values to a parallel
 		# threading dict.
 		items = list(a['$foreach'])
-		logger.debug(f'foreach.items:{items}')
+		logger.debug('foreach.items:%s',items)
 		akey = self._autokey('foreach:')
 		throt = a['$throttle'] if '$throttle' in a else self._throttle
 		ret = {
 			'$throttle':throt,
 			'$sub':1
 		}
-		kilen = len(str(len(items)))
-		for i in range(len(items)):
-			key = f'{akey}:%0{kilen}i' % (i,) # 'foreach:x:00i' or such
-			if True:
-				b = dict(a)
-				if '$throttle' in b:
-					del b['$throttle']
-				if '$throttle' in ts.top():
-					b['$throttle'] = ts.top()['$throttle']
+		# Every item's object is the same apart from $param, so strip and
+		# fill in the rest once rather than per item.
+		base = {k:v for k,v in a.items() if k != '$throttle' and k != '$foreach'}
+		top = ts.top()
+		if '$throttle' in top:
+			base['$throttle'] = top['$throttle']
+		tmpl = f'{akey}:%0{len(str(len(items)))}i' # 'foreach:x:00i' or such
+		for i,item in enumerate(items):
+			b = base.copy()
 			# Assign the actual object to $param.
-			b['$param'] = items[i]
-			del b['$foreach']
-			ret[key] = b
-		logger.info(f'foreach replace: {ret}')
+			b['$param'] = item
+			ret[tmpl % i] = b
+		logger.info('foreach replace: %s',ret)
 		return {'$replace':ret}
 	
 	def _handle_base_wait(self,_,a,ts,*r):
-		logger.info(f'_handle_base_wait {a} {ts}')
+		logger.info('_handle_base_wait %s %s',a,ts)
 		assert '$wait' in a
 		assert type(a['$wait']) is list
 		self.wait(*a['$wait'])
 		return ts['$result'] if '$result' in ts else None
 	
 	def _handle_base_run(self,_,a,ts,*r):
-		logger.info(f'_handle_base_run {a} {ts}, {a["$run"].__name__}')
+		logger.info('_handle_base_run %s %s, %s',a,ts,a['$run'].__name__)
 		f = a['$run']
 		return f(a,ts)
 	
+	def _candidates(self,t):
+		# Registrations that can apply to type t, in priority order: pre ones
+		# first and in order of addition, then the rest reversed so latest
+		# entries take highest priority.
+		def fits(types):
+			return types is None or t in types
+		r = [(check,f,key) for check,f,types,key in self._matches_pre \
+			if fits(types)]
+		r.extend((check,f,key) for check,f,types,key in reversed(self._matches) \
+			if fits(types))
+		return r
+	
 	def _find_matchfunc(self,a):
-		# Check for match against register (in reverse order for now, so latest
-		# entries take highest priority).
-		for check,f in self._matches_pre:
-			# Pre registrations run first and in order of addition.
-			assert check
+		t = type(a)
+		# One set intersection tells which keyed registrations are in play,
+		# rather than each of them probing the dict in turn.
+		present = frozenset(a.keys() & self._dispatch_keys) \
+			if isinstance(a,dict) else frozenset()
+		sig = (t,present)
+		f = self._resolved.get(sig)
+		if f is not None:
+			return f
+		cands = self._dispatch.get(t)
+		if cands is None:
+			cands = self._dispatch[t] = self._candidates(t)
+		# A match reached without running any check depends only on the type
+		# and keys present, so it's remembered for the next object alike.
+		pure = True
+		for check,f,key in cands:
 			assert f
-			if check(a):
+			if key is not None and key not in present:
+				continue
+			if check is None:
+				if pure:
+					self._resolved[sig] = f
 				return f
-		for i in range(len(self._matches)-1,0-1,-1):
-			# Whereas these are reversed.
-			check,f = self._matches[i]
-			assert check
-			assert f
 			if check(a):
 				return f
+			pure = False
 		raise NoMatchedFunctionError(f'ob: {a}')
 	
-	def _process_step(self,a=None,tstack=None,key=None):
-		while not (a is None):
+	def _step_scope(self,a,tstack,key):
+		''' Return the object and tablestack one step of a runs with. '''
+		if isinstance(a,dict):
 			# Add in param object for dynamic property availability.
-			ts = tstack.clone().add(a['$param']) \
-				if _dhas(a,'$param') else tstack
+			# An empty $param adds nothing to look up, so skip the clone.
+			p = a.get('$param')
+			if p:
+				tstack = tstack.clone().add(p)
 			# $sub is an indicator that normal subkeys need a thread prefix.
 			# It's meant for parallel thread objects that must maintain
 			# searchable reference to their parent key in the final flat
 			# tbraid table.
-			if _dhas(a,'$sub'):
-				b = dict(a)
-				for k in list(b.keys()):
-					if k[0] != '$':
-						b[f'{key}:{k}'] = b[k]
-						del b[k]
+			if '$sub' in a:
+				b = {}
+				for k,v in a.items():
+					b[k if k.startswith('$') else f'{key}:{k}'] = v
 				a = b
+		return a,tstack
+	
+	def _process_step(self,a=None,tstack=None,key=None,f=None):
+		''' Run a, following any $replace results; f is a matchfunc already
+		resolved for a, if the caller had one. '''
+		find = self._find_matchfunc
+		scope = self._step_scope
+		while True:
+			a,ts = scope(a,tstack,key)
 			# Match the correct func to run and run it.
-			f = self._find_matchfunc(a)
+			if f is None:
+				f = find(a)
 			val = f(self,a,ts,key)
+			f = None
+			# Coroutine handlers (see arun()) get a loop of their own here.
+			if inspect.iscoroutine(val):
+				val = asyncio.run(val)
 			# A matchfunc can map to another value using {$replace:<new-val>},
 			# so we don't have private handle methods calling others.
-			logging.info(f'tworker val: {val}')
-			if _dhas(val,'$replace'):
-				logging.info(f'  replacing...\n  ({a})\n  with ({val["$replace"]})')
-				a = val['$replace']
+			logger.info('tworker val: %s',val)
+			if not (isinstance(val,dict) and '$replace' in val):
+				return val
+			logger.info('  replacing...\n  (%s)\n  with (%s)',a,val['$replace'])
+			a = val['$replace']
+	
+	async def _aprocess_step(self,a=None,tstack=None,key=None,f=None,pool=None):
+		''' _process_step for arun(), awaiting coroutine handlers and running
+		the others on pool's threads. '''
+		find = self._find_matchfunc
+		scope = self._step_scope
+		afuncs = self._afuncs
+		loop = asyncio.get_running_loop()
+		while True:
+			a,ts = scope(a,tstack,key)
+			if f is None:
+				f = find(a)
+			af = afuncs.get(f)
+			if af is not None:
+				val = await af(self,a,ts,key)
+			elif inspect.iscoroutinefunction(f):
+				val = await f(self,a,ts,key)
 			else:
-				break
-		return val
+				val = await loop.run_in_executor(pool,f,self,a,ts,key)
+				# Sync handlers can hand back a coroutine too, say from an
+				# async $run callable.
+				if inspect.iscoroutine(val):
+					val = await val
+			f = None
+			if not (isinstance(val,dict) and '$replace' in val):
+				return val
+			a = val['$replace']
 	
-	def run(self,ob=None,tt=None,ts=None,**kw):
-		''' Run against a provided json/dict object, execution logic. '''
+	def _prepare(self,ob,tt,kw):
+		''' Normalize a run object and claim table entries for its thread keys,
+		returning the throttle and a (key,value,matchfunc) list to start. '''
 		ob = ob or {}
-		ts = ts or self._tstack
-		tt = tt or self._ttable
 		if type(ob) in (list,tuple):
 			obx = {}
 			obx['[:root:]'] = ob # should only apply to root run object
 			ob = obx
 		for k,v in kw.items():
 			ob[k] = v
-		# TODO: Unit tests for each of these special keys.
-		special = set([
-			'$throttle','$async','$replace','$param','$sub','$result'])
 		throt = self._throttle
 		if '$throttle' in ob:
 			throt = ob['$throttle']
-		# NOTE: Looks like each run() has its own semaphore, which prevents some
-		#   problems, but leaves the whole open to rampant sub-threading.
-		# Worker function to handle various input types.
-		sem = threading.Semaphore(throt)
-		def tworker(a,tstack,key):
-			with sem:
-				try:
-					val = self._process_step(a,tstack,key)
-					tt[key]['value'] = val
-					tt[key]['state'] = 'done'
-				except Exception as e:
-					trace = traceback.format_exc()
-					logging.warning(f'tworker {key}:({a}), exception:\n{trace}')
-					tt[key]['state'] = 'error'
 		# Loop through keys for threads to run.
-		added = set()
+		added = []
+		events = self._events
+		find = self._find_matchfunc
+		literal = self._handle_base_special_literals
+		ignore = self._handle_base_ignore
 		for k,v in ob.items():
-			if k in special:
-				continue
-			if k[0] == '$':
+			# Markers aren't threads, the special keys ($throttle, $async,
+			# $replace, $param, $sub, $result) included.
+			# TODO: Unit tests for each of these special keys.
+			if k.startswith('$'):
 				continue
 			if k in tt:
 				raise KeyOverrideAttemptError(k)
-			t = threading.Thread(target=tworker,args=(v,ts,k),name=f't.{k}')
-			ob = {
+			# Resolve the handler here rather than on the worker.  $sub objects
+			# get their keys rewritten first, so leave those to the worker, as
+			# well as anything unmatched so it errors there like always.
+			f = None
+			if not _dhas(v,'$sub'):
+				try:
+					f = find(v)
+				except NoMatchedFunctionError:
+					pass
+			# Constants that would only be handed back as-is ('@' aliases
+			# aside) are stored now rather than given a task of their own.
+			if type(v) in _SCALARS and (f == literal or f == ignore) \
+					and not (type(v) is str and v[:1] == '@'):
+				tt[k] = {
+					'state':'done',
+					'value':v,
+					'future':None,
+					'event':_COMPLETED_EVENT
+				}
+				events.append(_COMPLETED_EVENT)
+				continue
+			ev = threading.Event()
+			tt[k] = {
 				'state':'not-started',
 				'value':None,
-				'thread':t
+				'future':None,
+				'event':ev
 			}
-			tt[k] = ob
-			added.add(k)
-		# Start all threads after tt's been assigned its objects.
-		for k in added:
-			logger.info(f'  start thread ({k})')
-			tt[k]['thread'].start()
+			events.append(ev)
+			added.append((k,v,f))
+		self._touch()
+		return throt,added
+	
+	def run(self,ob=None,tt=None,ts=None,**kw):
+		''' Run against a provided json/dict object, execution logic. '''
+		ts = ts or self._tstack
+		tt = tt or self._ttable
+		throt,added = self._prepare(ob,tt,kw)
+		# NOTE: Each run() has its own pool bounded by its throttle.  One pool
+		#   shared by everything would deadlock, since parallel objects hold a
+		#   worker while waiting on sub-threads queued behind them.
+		# Worker function to handle various input types.
+		def tworker(a,tstack,key,f):
+			# Pool threads are reused, so name them for the task at hand.
+			threading.current_thread().name = f't.{key}'
+			try:
+				val = self._process_step(a,tstack,key,f)
+				tt[key]['value'] = val
+				tt[key]['state'] = 'done'
+			except Exception as e:
+				# Lazy args, the trace and a's repr are only built if emitted.
+				if logger.isEnabledFor(logging.WARNING):
+					logger.warning('tworker %s:(%s), exception:\n%s',
+						key,a,traceback.format_exc())
+				tt[key]['state'] = 'error'
+			finally:
+				self._touch()
+				# Signal waiters on both the 'done' and 'error' paths.
+				tt[key]['event'].set()
+		# Submit all tasks after tt's been assigned its objects.
+		if added:
+			pool = concurrent.futures.ThreadPoolExecutor(
+				max_workers=throt,thread_name_prefix='tbraid')
+			for k,v,f in added:
+				logger.info('  submit task (%s)',k)
+				tt[k]['future'] = pool.submit(tworker,v,ts,k,f)
+			# Queued tasks still run, and the workers exit once they're done.
+			pool.shutdown(wait=False)
+		return self
+	
+	async def arun(self,ob=None,tt=None,ts=None,**kw):
+		''' Coroutine run(), returning once the object's keys have settled.
+		Each key is a task on the running loop, throttled by a semaphore;
+		coroutine handlers are awaited there, and the rest (blocking ones like
+		$wait and nested objects) go to worker threads. '''
+		ts = ts or self._tstack
+		tt = tt or self._ttable
+		throt,added = self._prepare(ob,tt,kw)
+		sem = asyncio.Semaphore(throt)
+		# NOTE: Sync steps get a pool sized to the throttle, like run().  The
+		#   loop's default executor is smaller, and steps blocked in $wait
+		#   could hold all of it while the keys they wait on queue behind.
+		pool = concurrent.futures.ThreadPoolExecutor(
+			max_workers=throt,thread_name_prefix='tbraid.a')
+		async def aworker(a,tstack,key,f):
+			async with sem:
+				try:
+					val = await self._aprocess_step(a,tstack,key,f,pool)
+					tt[key]['value'] = val
+					tt[key]['state'] = 'done'
+				except Exception as e:
+					if logger.isEnabledFor(logging.WARNING):
+						logger.warning('aworker %s:(%s), exception:\n%s',
+							key,a,traceback.format_exc())
+					tt[key]['state'] = 'error'
+				finally:
+					self._touch()
+					# Threaded waiters (a nested '@key' alias, say) still block
+					# on the event.
+					tt[key]['event'].set()
+		tasks = []
+		for k,v,f in added:
+			t = tt[k]['future'] = asyncio.create_task(aworker(v,ts,k,f))
+			tasks.append(t)
+		try:
+			if tasks:
+				# Like wait(), a timeout leaves the tasks running.
+				pending = (await asyncio.wait(tasks,timeout=self._timeout))[1]
+				if pending:
+					raise WaitTimeoutError(f'timeout: {self._timeout}s')
+		finally:
+			# Submitted steps still finish, then the workers exit.
+			pool.shutdown(wait=False)
 		return self
 	
 	def wait(self,*r):
 		''' Wait for provided thread-names to finish before continuing. '''
-		# NOTE: There are more elegant ways to do this than a sleep loop, but
-		#   for now it's reliable so I'll come back to it later.
-		start = time.time()
-		while time.time() < start + self._timeout:
-			kr = list((r if len(r) else self._ttable.keys()))
-			logger.debug(f'kr: {kr}\n{self._ttable}')
-			if len([k for k in kr if \
-					self._ttable[k]['state'] in ('done','error')]) == len(kr):
-				return self
-			time.sleep(self._sleep)
-		raise WaitTimeoutError(f'timeout: {self._timeout}s')
+		# Each table entry carries an Event set by its worker once it lands in
+		# either 'done' or 'error', so there's no polling latency here.
+		deadline = time.monotonic() + self._timeout
+		def block(ev):
+			if not ev.wait(max(0,deadline-time.monotonic())):
+				raise WaitTimeoutError(f'timeout: {self._timeout}s')
+		logger.debug('kr: %s\n%s',r,self._ttable)
+		if len(r):
+			for k in r:
+				block(self._ttable[k]['event'])
+			return self
+		# Without names wait on everything, walking the events in the order they
+		# were added from the last point known settled.  Threads started while
+		# waiting (say, by async sub-objects) append to the list, so they count.
+		events = self._events
+		i = self._settled
+		while i < len(events):
+			block(events[i])
+			i += 1
+		if events is self._events:
+			self._settled = max(self._settled,i)
+		return self
 
 
 if __name__ == '__main__':
@@ -32,9 +32,97 @@ def test_chatbraid_process_prompt():
     processed = cb._process(prompt, ts)
     assert processed == [['system', 'sys bar'], ['user', 'user bar']]
 
+def test_chatbraid_process_prompt_passthrough():
+    cb = chatbraid(DummyLLMManager())
+    ts = {'foo': 'bar'}
+    # No named fields, so no formatting (which would choke on '% o')
+    assert cb._process('50% off', ts) == '50% off'
+    assert cb._process('50%% off %(foo)s', ts) == '50% off bar'
+    # '%%' escapes alone still get formatted
+    assert cb._process('Give it 100%% effort', ts) == 'Give it 100% effort'
+
 def test_chatbraid_default_llm_params():
     llm = DummyLLMManager()
     cb = chatbraid(llm, default_llm_params={'model': 'gpt-4.1-mini'})
     cb.run({'q': {'$llm': 'test'}})
     cb.wait('q')
     assert llm.last_request['model'] == 'gpt-4.1-mini'
+
+def test_chatbraid_custom_manager_gets_mapping():
+    from collections.abc import Mapping
+    class Manager:
+        def call(self, request, meta=None):
+            self.request = request
+            request['seen'] = True
+            return 'ok'
+    llm = Manager()
+    cb = chatbraid(llm, default_llm_params={'model': 'm'})
+    source = {'$llm': 'hi'}
+    cb.run({'q': source})
+    cb.wait('q')
+    assert cb['q'] == 'ok'
+    assert isinstance(llm.request, Mapping)
+    assert llm.request['model'] == 'm' and llm.request['$llm'] == 'hi'
+    # Writes land in the request's own layer, not the braid object
+    assert 'seen' not in source
+
+def test_chatbraid_process_compiled_template():
+    from chatbraid import _compile_template
+    cb = chatbraid(DummyLLMManager())
+    ts = {'name': 'Ada', 'n': 3}
+    assert _compile_template('hi %(name)s, %(n)s') == (('hi ', ', ', ''), ('name', 'n'))
+    assert cb._process('hi %(name)s, %(n)s', ts) == 'hi Ada, 3'
+    # Other specs fall back to '%' formatting
+    assert _compile_template('%(n)03d') is None
+    assert cb._process('%(n)03d %(name)s', ts) == '003 Ada'
+    # Missing keys still leave the prompt as is
+    assert cb._process('hi %(nobody)s', ts) == 'hi %(nobody)s'
+
+def test_chatbraid_arun_awaits_acall():
+    import asyncio
+    import threading
+    class AsyncManager:
+        def __init__(self):
+            self.running = 0
+            self.peak = 0
+            self.threads = set()
+        def call(self, request, meta=None):
+            return 'sync:' + request['$llm']
+        async def acall(self, request, meta=None):
+            self.threads.add(threading.current_thread())
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            await asyncio.sleep(.05)
+            self.running -= 1
+            return 'async:' + request['$llm']
+    llm = AsyncManager()
+    cb = chatbraid(llm)
+    asyncio.run(cb.arun({f'q{i}': {'$llm': 'hi %(n)s', '$param': {'n': i}} for i in range(5)}))
+    assert [cb[f'q{i}'] for i in range(5)] == [f'async:hi {i}' for i in range(5)]
+    # All five in flight at once, on the loop's own thread
+    assert llm.peak == 5
+    assert llm.threads == {threading.current_thread()}
+    # run() keeps using the blocking call()
+    cb.run({'r': {'$llm': 'yo'}}).wait('r')
+    assert cb['r'] == 'sync:yo'
+
+def test_chatbraid_templated_prompts_skip_semantic_cache():
+    pytest.importorskip('numpy')
+    # Cosine ~0.999, well over the default 0.92 threshold
+    vectors = {'about Ada': [1.0, 0.0], 'about Bob': [0.999, 0.04]}
+    manager = LLMManager(semantic_cache=lambda s: vectors[s])
+    manager._dispatch = lambda request, meta=None: 'answer ' + request['$llm']
+    cb = chatbraid(manager)
+    cb.run({
+        'a': {'$llm': 'about %(name)s', '$param': {'name': 'Ada'}},
+    }).wait()
+    cb.run({
+        'b': {'$llm': 'about %(name)s', '$param': {'name': 'Bob'}},
+    }).wait()
+    assert cb['a'] == 'answer about Ada'
+    assert cb['b'] == 'answer about Bob'
+    # Sent as plain prompts, the pair would share a semantic hit
+    plain = LLMManager(semantic_cache=lambda s: vectors[s])
+    plain._dispatch = manager._dispatch
+    plain.call({'$llm': 'about Ada'})
+    assert plain.call({'$llm': 'about Bob'}) == 'answer about Ada'
@@ -24,17 +24,174 @@ def test_llmmanager_call_openai(monkeypatch):
         assert result == "Paris"
 
 def test_llmmanager_call_ollama(monkeypatch):
+    monkeypatch.delenv('OLLAMA_HOST', raising=False)
     manager = LLMManager()
     req = {'$llm': 'Say hi', 'provider': 'ollama', 'model': 'llama2'}
-    fake_output = '{"response": "Hello"}'
-    fake_proc = MagicMock()
-    fake_proc.stdout = fake_output
-    monkeypatch.setattr("subprocess.run", lambda *a, **kw: fake_proc)
+    fake_resp = MagicMock()
+    fake_resp.json.return_value = {"response": "Hello"}
+    posted = {}
+    def fake_post(url, **kw):
+        posted['url'] = url
+        posted['json'] = kw['json']
+        return fake_resp
+    monkeypatch.setattr(manager._session, "post", fake_post)
     result = manager._call_ollama(req)
     assert result == "Hello"
+    assert posted['url'] == 'http://localhost:11434/api/generate'
+    assert posted['json'] == {'model': 'llama2', 'prompt': 'Say hi', 'stream': False}
 
 def test_llmmanager_call_invalid_provider():
     manager = LLMManager()
     req = {'$llm': 'test', 'provider': 'unknown'}
     with pytest.raises(ValueError):
         manager.call(req)
+
+def test_llmmanager_cache():
+    manager = LLMManager(cache_size=2)
+    calls = []
+    def fake_dispatch(request, meta=None):
+        calls.append(request['$llm'])
+        meta['model'] = request.get('model')
+        return request['$llm'][::-1]
+    manager._dispatch = fake_dispatch
+    req = {'$llm': 'abc', 'model': 'm'}
+    assert manager.call(req) == 'cba'
+    meta = {}
+    assert manager.call(dict(req), meta=meta) == 'cba'
+    assert calls == ['abc']
+    assert meta == {'model': 'm', 'cached': True}
+    # Different params, opt-out, and LRU eviction all reach the provider again
+    manager.call({'$llm': 'abc', 'model': 'other'})
+    manager.call(dict(req, no_cache=True))
+    manager.call({'$llm': 'xyz'})
+    manager.call(req)
+    assert calls == ['abc', 'abc', 'abc', 'xyz', 'abc']
+
+def test_llmmanager_semantic_cache():
+    pytest.importorskip('numpy')
+    vectors = {'name a color': [1.0, 0.0], 'name one colour': [0.99, 0.05], 'tell a joke': [0.0, 1.0]}
+    manager = LLMManager(semantic_cache=lambda s: vectors[s])
+    calls = []
+    def fake_dispatch(request, meta=None):
+        calls.append(request['$llm'])
+        return 'answer to ' + request['$llm']
+    manager._dispatch = fake_dispatch
+    assert manager.call({'$llm': 'name a color'}) == 'answer to name a color'
+    meta = {}
+    assert manager.call({'$llm': 'name one colour'}, meta=meta) == 'answer to name a color'
+    assert meta['cached'] == 'semantic'
+    assert manager.call({'$llm': 'tell a joke'}) == 'answer to tell a joke'
+    # Opting out, or a different model, misses
+    manager.call({'$llm': 'name one colour', 'semantic_cache': False})
+    manager.call({'$llm': 'name one colour', 'model': 'other'})
+    assert calls == ['name a color', 'tell a joke', 'name one colour', 'name one colour']
+
+def test_llmmanager_call_openai_stream():
+    manager = LLMManager(openai_api_key='fake-key')
+    def chunk(text, usage=None):
+        choices = [MagicMock(delta=MagicMock(content=text))] if text is not None else []
+        return MagicMock(id='cmpl-1', usage=usage, choices=choices)
+    usage = MagicMock()
+    fake_client = MagicMock()
+    fake_client.chat.completions.create.return_value = iter(
+        [chunk('Pa'), chunk('ris'), chunk(None, usage=usage)])
+    seen = []
+    meta = {}
+    with patch('chatbraid.OpenAI', return_value=fake_client):
+        req = {'$llm': 'What is the capital of France?', 'stream': seen.append}
+        assert manager.call(req, meta=meta) == "Paris"
+    assert seen == ['Pa', 'ris']
+    assert meta['usage'] is usage
+    assert meta['id'] == 'cmpl-1'
+    assert fake_client.chat.completions.create.call_args.kwargs['stream'] is True
+    # Served from cache afterwards, with the whole text as a single chunk
+    assert manager.call(req) == "Paris"
+    assert seen == ['Pa', 'ris', 'Paris']
+
+def test_llmmanager_reuses_openai_client():
+    manager = LLMManager(openai_api_key='fake-key', cache_size=0)
+    fake_response = MagicMock()
+    fake_response.choices = [MagicMock(message=MagicMock(content="Paris"))]
+    fake_client = MagicMock()
+    fake_client.chat.completions.create.return_value = fake_response
+    with patch('chatbraid.OpenAI', return_value=fake_client) as ctor:
+        manager.call({'$llm': 'a'})
+        manager.call({'$llm': 'b'})
+    assert ctor.call_count == 1
+
+def test_llmmanager_disk_cache(tmp_path):
+    path = str(tmp_path / 'cache' / 'cache.db')
+    calls = []
+    def fake_dispatch(request, meta=None):
+        calls.append(request['$llm'])
+        meta['model'] = 'm'
+        return 'answer'
+    first = LLMManager(cache_path=path)
+    first._dispatch = fake_dispatch
+    assert first.call({'$llm': 'q'}) == 'answer'
+    first._disk.flush()
+    # A fresh manager, as on the next run, reads it back without a call
+    second = LLMManager(cache_path=path)
+    second._dispatch = fake_dispatch
+    meta = {}
+    assert second.call({'$llm': 'q'}, meta=meta) == 'answer'
+    assert meta == {'model': 'm', 'cached': 'disk'}
+    assert calls == ['q']
+    first._disk.close()
+    second._disk.close()
+    # Closed stores drop writes rather than queueing them forever
+    first._disk.put(b'k', 'v', {})
+    first._disk.flush()
+
+def test_llmmanager_disk_cache_ttl(tmp_path):
+    import sqlite3
+    path = str(tmp_path / 'cache.db')
+    manager = LLMManager(cache_path=path, cache_ttl=60)
+    manager._dispatch = lambda request, meta=None: 'answer'
+    manager.call({'$llm': 'q'})
+    manager._disk.close()
+    conn = sqlite3.connect(path)
+    conn.execute('UPDATE r SET ts = ts - 120')
+    conn.commit()
+    conn.close()
+    # Reopening prunes the expired row
+    again = LLMManager(cache_path=path, cache_ttl=60)
+    again._disk.close()
+    conn = sqlite3.connect(path)
+    assert conn.execute('SELECT COUNT(*) FROM r').fetchone()[0] == 0
+    conn.close()
+
+def test_llmmanager_acall():
+    import asyncio
+    manager = LLMManager()
+    calls = []
+    async def fake_adispatch(request, meta=None):
+        calls.append(request['$llm'])
+        await asyncio.sleep(0.01)
+        return request['$llm'].upper()
+    manager._adispatch = fake_adispatch
+    async def main():
+        return await asyncio.gather(*(manager.acall({'$llm': p}) for p in ('a', 'b', 'a')))
+    assert asyncio.run(main()) == ['A', 'B', 'A']
+    assert sorted(calls) == ['a', 'a', 'b']
+
+def test_llmmanager_acall_semantic_off_loop():
+    pytest.importorskip('numpy')
+    import asyncio, time
+    def slow_encoder(s):
+        time.sleep(0.2)
+        return [1.0, float(len(s))]
+    manager = LLMManager(semantic_cache=slow_encoder)
+    async def fake_adispatch(request, meta=None):
+        return 'x'
+    manager._adispatch = fake_adispatch
+    async def main():
+        return await asyncio.gather(*(manager.acall({'$llm': str(i), 'model': str(i)}) for i in range(4)))
+    start = time.time()
+    asyncio.run(main())
+    # Encoders ran in worker threads, not one after another on the loop
+    assert time.time() - start < 0.6
+
+def test_llmmanager_ollama_path_deprecated():
+    with pytest.warns(DeprecationWarning):
+        LLMManager(ollama_path='ollama')
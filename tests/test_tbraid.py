@@ -24,6 +24,34 @@ def test_tablestack_clone():
     assert ts2['b'] == 2
     assert 'b' in ts2
 
+def test_tablestack_flat_cache():
+    ts = tablestack({'a': 1})
+    f1 = ts.flat()
+    assert ts.flat() is f1
+    ts2 = ts.clone()
+    ts2['b'] = 2  # shared frame, written through the clone
+    assert ts.flat() == {'a': 1, 'b': 2}
+    ts.add({'a': 3})
+    assert ts.flat()['a'] == 3
+    tb = tbraid()
+    ts3 = tablestack(tb)
+    assert ts3.flat() == {}
+    tb.run({'x': 1}).wait()
+    assert ts3.flat() == {'x': 1}
+
+def test_tablestack_live_frames():
+    tb = tbraid()
+    ts = tablestack({'x': 'bottom'}, tb, {'y': 'top'})
+    tb.run({'x': 'braid', 'y': 'braid', 'z': 'braid'}).wait()
+    assert ts['x'] == 'braid'  # live frame above shadows the dict below
+    assert ts['y'] == 'top'
+    assert ts['z'] == 'braid'
+    ts2 = ts.clone()
+    ts2['w'] = 1
+    assert ts['w'] == 1
+    with pytest.raises(KeyError):
+        ts['nope']
+
 def test_tbraid_run_and_wait():
     tb = tbraid(interval=0.01)
     tb.run({
@@ -46,6 +74,18 @@ def test_tbraid_handle_base_list():
     tb.wait('seq')
     assert tb['seq'] == 3
 
+def test_tbraid_wait_no_poll_latency():
+    import time
+    tb = tbraid(interval=5)
+    start = time.time()
+    tb.run({
+        'a': 1,
+        'b': ['@a', 2]
+    })
+    tb.wait()
+    assert tb['b'] == 2
+    assert time.time() - start < 1
+
 def test_tbraid_wait_timeout():
     tb = tbraid(interval=0.01, timeout=0.05)
     def slow_fn(a, ts):
@@ -71,3 +111,172 @@ def test_tbraid_no_matched_function():
     tb._matches = []
     with pytest.raises(NoMatchedFunctionError):
         tb._find_matchfunc(123)
+
+def test_tbraid_register_types():
+    tb = tbraid()
+    tb.register(None, lambda _, a, ts, *r: a * 10, types=int)
+    tb.run({'i': 4, 's': 'x', 'l': [1, 2]}).wait()
+    assert tb['i'] == 40
+    assert tb['s'] == 'x'
+    assert tb['l'] == 20
+
+def test_tbraid_wait_alias():
+    tb = tbraid()
+    tb.run({
+        'a': 1,
+        'b': 2,
+        'c': ['@a,b \n', lambda a, t: t['a'] + t['b']],
+        'd': 'not @ an alias',
+        'e': '@,',
+    }).wait()
+    assert tb['c'] == 3
+    assert tb['d'] == 'not @ an alias'
+    assert tb['e'] == '@,'
+
+def test_tbraid_register_key():
+    tb = tbraid()
+    tb.register(None, lambda _, a, ts, *r: 'custom:' + a['$custom'], types=dict, key='$custom')
+    tb.run({
+        'c': {'$custom': 'x'},
+        'plain': {'$nope': 1},
+        # Latest registration wins when several keys are present
+        'both': {'$custom': 'y', '$run': lambda a, t: 'ran'},
+    }).wait()
+    assert tb['c'] == 'custom:x'
+    assert tb['plain'] is None
+    assert tb['both'] == 'custom:y'
+
+def test_tbraid_dispatch_memo():
+    tb = tbraid()
+    f = tb._find_matchfunc({'$wait': ['x'], 'y': 1})
+    assert f == tb._handle_base_wait
+    assert tb._resolved[(dict, frozenset({'$wait'}))] == f
+    # Matches that ran a check stay unmemoized, they depend on the value
+    tb.register(lambda a: a == 5, lambda _, a, ts, *r: 'five')
+    assert not tb._resolved
+    assert tb._find_matchfunc(5)(tb, 5, None) == 'five'
+    assert tb._find_matchfunc(6) == tb._handle_base_special_literals
+    assert (int, frozenset()) not in tb._resolved
+
+def test_tbraid_process_step_none():
+    tb = tbraid()
+    assert tb._process_step(None, tablestack({}), 'k') is None
+    # A $replace with None runs None, rather than returning the $replace
+    tb.register(None, lambda _, a, ts, *r: {'$replace': None}, types=dict, key='$gone')
+    tb.run({'g': {'$gone': 1}}).wait()
+    assert tb['g'] is None
+
+def test_tbraid_arun():
+    import asyncio
+    running = []
+    peak = []
+    async def handler(_, a, ts, *r):
+        running.append(1)
+        peak.append(len(running))
+        await asyncio.sleep(.05)
+        running.pop()
+        return a['$fetch'] * 2
+    async def asquare(a, ts):
+        return 9
+    tb = tbraid()
+    tb.register(None, handler, types=dict, key='$fetch')
+    asyncio.run(tb.arun({
+        '$throttle': 2,
+        'a': {'$fetch': 1}, 'b': {'$fetch': 2}, 'c': {'$fetch': 3},
+        'd': 'plain',
+        'e': {'$run': asquare},
+        'f': '@a,b',
+    }))
+    assert [tb[k] for k in 'abcde'] == [2, 4, 6, 'plain', 9]
+    assert max(peak) == 2
+    # Coroutine handlers work under run() as well
+    tb2 = tbraid()
+    tb2.register(None, handler, types=dict, key='$fetch')
+    tb2.run({'x': {'$fetch': 5}, 'y': {'$run': asquare}}).wait()
+    assert tb2['x'] == 10 and tb2['y'] == 9
+
+def test_tbraid_arun_blocking_steps():
+    import asyncio
+    # More blocked $wait steps than the loop's default executor has threads
+    # (min(32, cpus+4)), all waiting on one more key that still needs one.
+    ob = {f'w{i}': {'$wait': ['x']} for i in range(40)}
+    ob['x'] = {'$run': lambda a, t: 'X'}
+    tb = tbraid(timeout=3, throttle=50)
+    asyncio.run(tb.arun(ob))
+    assert tb['x'] == 'X'
+    assert all(tb._ttable[f'w{i}']['state'] == 'done' for i in range(40))
+
+def test_tbraid_compile():
+    def total(n):
+        s = 0
+        for i in range(n):
+            s += i
+        return s
+    kernel = tbraid.compile(total)
+    tb = tbraid()
+    tb.run({'t': {'$run': lambda a, ts: kernel(10)}}).wait()
+    assert tb['t'] == 45
+
+def test_tbraid_scalar_fast_path():
+    tb = tbraid()
+    tb.register(None, lambda _, a, ts, *r: a + 1, types=float)
+    tb.run({'i': 1, 's': 'x', 'n': None, 'f': 1.5, 'w': '@i'})
+    # Settled by run() itself, no task submitted
+    assert tb._ttable['i']['state'] == 'done' and tb._ttable['i']['future'] is None
+    assert tb['i'] == 1 and tb['s'] == 'x' and tb['n'] is None
+    # Claimed types and '@' aliases still get a task
+    assert tb._ttable['f']['future'] is not None
+    assert tb._ttable['w']['future'] is not None
+    tb.wait()
+    assert tb['f'] == 2.5
+
+def test_tbraid_compile_numba():
+    pytest.importorskip('numba')
+    def total(n):
+        s = 0
+        for i in range(n):
+            s += i
+        return s
+    kernel = tbraid.compile(total, cache=False)
+    assert kernel.py_func is total  # a numba dispatcher, not the plain function
+    tb = tbraid()
+    tb.run({'t': {'$run': lambda a, ts: kernel(10)}}).wait()
+    assert tb['t'] == 45
+
+def test_tablestack_clone_frames():
+    base = {'a': 1}
+    ts = tablestack(base)
+    c = ts.clone().add({'b': 2})
+    assert c['a'] == 1 and c['b'] == 2
+    assert 'b' not in ts
+    c['a'] = 3  # writes go to the clone's own top frame
+    assert base['a'] == 1
+
+def test_tablestack_contains():
+    ts = tablestack({'zero': 0}, {'none': None})
+    assert 'zero' in ts and 'none' in ts
+    assert 'missing' not in ts
+
+def test_tbraid_falsy_result():
+    def zero(a, ts):
+        ts['$result'] = 0
+        return 'set'
+    tb = tbraid()
+    tb.run({'o': {'a': {'$run': zero}, 'b': '@a'}}).wait()
+    # A falsy $result is still the result, from the object and from $wait
+    assert tb['o'] == 0
+    assert tb['b'] == 0
+
+def test_tablestack_flat_scoped_invalidation():
+    from tbraid import _VersionedDict
+    frame = _VersionedDict()
+    ts_a = tablestack({'q': 1})
+    ts_b = tablestack({'r': 2}, frame)
+    f_a = ts_a.flat()
+    # A write to a versioned frame ts_a doesn't hold leaves its cache alone
+    ts_b['z'] = 1
+    assert ts_a.flat() is f_a
+    assert ts_b.flat() == {'r': 2, 'z': 1}
+    ts_c = ts_b.clone()
+    ts_c['z'] = 3  # shared frame, written through the clone
+    assert ts_b.flat()['z'] == 3